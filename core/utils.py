@@ -1,5 +1,6 @@
 import os
 import argparse
+import tempfile
 from collections import defaultdict
 import logging
 
@@ -222,7 +223,67 @@ def get_pose_params(mat_path):
     return pose_params
 
 
+# read once at import; os.umask can only be queried by setting it, which is not thread-safe
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def load_pose_params(pose_path):
+    """Load pose parameters from a npy or mat file, caching mat results as npy
+
+    Parsing mat files with loadmat is slow, so the parameters are saved to
+    "<pose_path>.npy" next to the mat file and memory-mapped on later calls
+    while the cache is at least as new as the mat file.
+
+    Args:
+        pose_path (str): path of npy or mat file
+
+    Returns:
+        pose_params (numpy.ndarray): shape (L_video, 9), angle, translation, crop paramters
+    """
+    if pose_path[-3:] == "npy":
+        return np.load(pose_path)
+    elif pose_path[-3:] != "mat":
+        raise ValueError("Invalid pose file extension")
+
+    cache_path = pose_path + ".npy"
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(pose_path):
+        try:
+            return np.load(cache_path, mmap_mode="r")
+        except (OSError, ValueError):
+            # e.g. a cache another user wrote without read access for us; parse the mat file again
+            logging.warning("could not read pose cache %s", cache_path)
+
+    pose_params = get_pose_params(pose_path)
+    # written next to the cache and renamed onto it, so an interrupted run never leaves a
+    # truncated cache that is newer than the mat file
+    tmp_path = None
+    try:
+        fd, tmp_path = tempfile.mkstemp(suffix=".npy.tmp", dir=os.path.dirname(cache_path) or ".")
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, pose_params)
+        # mkstemp creates the file 0600; give the cache the mode np.save would have
+        os.chmod(tmp_path, 0o666 & ~_UMASK)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        logging.warning("could not write pose cache %s", cache_path)
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return pose_params
+
+
 def obtain_seq_index(index, num_frames, radius):
     seq = list(range(index - radius, index + radius + 1))
     seq = [min(max(item, 0), num_frames - 1) for item in seq]
     return seq
+
+
+def obtain_seq_indices(num_frames, radius):
+    """Vectorized obtain_seq_index for every frame at once.
+
+    Returns:
+        seq_indices (numpy.ndarray): (num_frames, 2 * radius + 1)
+    """
+    seq = np.arange(num_frames)[:, None] + np.arange(-radius, radius + 1)[None, :]
+    return np.clip(seq, 0, num_frames - 1)
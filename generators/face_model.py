@@ -92,10 +92,13 @@ class WarpingNet(nn.Module):
     def forward(self, input_image, descriptor):
         final_output={}
         output = self.hourglass(input_image, descriptor)
-        final_output['flow_field'] = self.flow_out(output)
+        # the flow and the sampling grid stay in fp32 under autocast: in half precision the
+        # normalised coordinates are too coarse and the warp snaps to whole-pixel steps
+        with torch.autocast(device_type=input_image.device.type, enabled=False):
+            final_output['flow_field'] = self.flow_out(output.float())
 
-        deformation = flow_util.convert_flow_to_deformation(final_output['flow_field'])
-        final_output['warp_image'] = flow_util.warp_image(input_image, deformation)
+            deformation = flow_util.convert_flow_to_deformation(final_output['flow_field'])
+            final_output['warp_image'] = flow_util.warp_image(input_image.float(), deformation)
         return final_output
 
 
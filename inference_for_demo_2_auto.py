@@ -1,7 +1,16 @@
 import argparse
+import collections
 import cv2
+import functools
 import json
 import os
+import pickle
+import subprocess
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+# must be set before torch initializes CUDA; grows segments instead of fragmenting the pool
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True,max_split_size_mb:512")
 
 import numpy as np
 import torch
@@ -10,9 +19,55 @@ import torchvision.transforms as transforms
 from PIL import Image
 
 from core.networks.styletalk import StyleTalk
-from core.utils import get_audio_window, get_pose_params, get_video_style_clip, obtain_seq_index
+from core.utils import get_audio_window, get_video_style_clip, load_pose_params, obtain_seq_indices
 from configs.default import get_cfg_defaults
 
+# renderer batches keep one shape per run, so the autotuned conv algorithms are reused
+torch.backends.cudnn.benchmark = True
+torch.backends.cudnn.allow_tf32 = True
+torch.set_float32_matmul_precision("high")
+
+
+def autocast():
+    """Mixed-precision context for inference: bf16 on GPUs with native bf16 (sm_80+), else fp16.
+
+    Volta and Turing only emulate bf16, so they get fp16 and its tensor cores. The renderer keeps its
+    flow field and warp in fp32 inside this context (see WarpingNet.forward).
+    """
+    dtype = torch.bfloat16 if torch.cuda.get_device_capability() >= (8, 0) else torch.float16
+    return torch.autocast(device_type="cuda", dtype=dtype)
+
+
+@torch.no_grad()
+def autocast_psnr(net_G, src_img, target_exp_concat):
+    """PSNR in dB of the first frame rendered under autocast against the same frame rendered in strict fp32."""
+    src_imgs, win_exp = src_img.unsqueeze(0), target_exp_concat[:1]
+    torch.backends.cudnn.allow_tf32 = torch.backends.cuda.matmul.allow_tf32 = False
+    try:
+        reference = net_G(src_imgs, win_exp)["fake_image"].float()
+    finally:
+        torch.backends.cudnn.allow_tf32 = torch.backends.cuda.matmul.allow_tf32 = True
+    with autocast():
+        reduced = net_G(src_imgs, win_exp)["fake_image"].float()
+    # the renderer outputs [-1, 1], a peak-to-peak range of 2
+    mse = (reduced - reference).pow(2).mean().clamp_min(1e-12)
+    return (4 / mse).log10().mul(10).item()
+
+
+def load_checkpoint(checkpoint_path, map_location):
+    """Memory-maps the checkpoint and materializes its tensors on map_location.
+
+    Checkpoints in the legacy (non-zip) format cannot be memory-mapped and are read normally. The
+    tensor-only unpickler is tried first; a checkpoint that also pickles other objects is loaded with the
+    full unpickler, as torch.load did before weights_only became the default.
+    """
+    mmap = zipfile.is_zipfile(checkpoint_path)
+    try:
+        return torch.load(checkpoint_path, map_location=map_location, mmap=mmap, weights_only=True)
+    except pickle.UnpicklingError:
+        print(f"Warning: {checkpoint_path} holds more than tensors, loading it with the full unpickler")
+        return torch.load(checkpoint_path, map_location=map_location, mmap=mmap, weights_only=False)
+
 
 @torch.no_grad()
 def get_eval_model(cfg):
@@ -20,25 +75,55 @@ def get_eval_model(cfg):
     content_encoder = model.content_encoder
     style_encoder = model.style_encoder
     decoder = model.decoder
-    checkpoint = torch.load(cfg.INFERENCE.CHECKPOINT)
-    model_state_dict = checkpoint["model_state_dict"]
-    content_encoder_dict = {k[16:]: v for k, v in model_state_dict.items() if k[:16] == "content_encoder."}
-    content_encoder.load_state_dict(content_encoder_dict, strict=True)
-    style_encoder_dict = {k[14:]: v for k, v in model_state_dict.items() if k[:14] == "style_encoder."}
-    style_encoder.load_state_dict(style_encoder_dict, strict=True)
-    decoder_dict = {k[8:]: v for k, v in model_state_dict.items() if k[:8] == "decoder."}
-    decoder.load_state_dict(decoder_dict, strict=True)
+    checkpoint = load_checkpoint(cfg.INFERENCE.CHECKPOINT, "cuda")
+    state_dicts = {"content_encoder.": {}, "style_encoder.": {}, "decoder.": {}}
+    for k, v in checkpoint["model_state_dict"].items():
+        for prefix, state_dict in state_dicts.items():
+            if k.startswith(prefix):
+                state_dict[k[len(prefix) :]] = v
+                break
+    del checkpoint
+    content_encoder.load_state_dict(state_dicts["content_encoder."], strict=True)
+    style_encoder.load_state_dict(state_dicts["style_encoder."], strict=True)
+    decoder.load_state_dict(state_dicts["decoder."], strict=True)
+    # the weights are copied into the modules; free the checkpoint's device tensors
+    del state_dicts
     model.eval()
     return content_encoder, style_encoder, decoder
 
 
 @torch.no_grad()
-def render_video(
-    net_G, src_img_path, exp_path, wav_path, output_path, silent=False, semantic_radius=13, fps=30, split_size=64
-):
+def get_split_size(net_G, src_img, target_exp_concat, max_split_size=64):
+    """Largest renderer batch that fits into the free GPU memory, capped at max_split_size.
+
+    Short clips are padded up to this batch, so the cap also bounds the frames rendered for nothing.
+    """
+    torch.cuda.synchronize()
+    torch.cuda.reset_peak_memory_stats()
+    allocated = torch.cuda.memory_allocated()
+    # probe the eager module so the measurement does not compile an extra batch shape
+    net_G = getattr(net_G, "_orig_mod", net_G)
+    with autocast():
+        net_G(src_img.unsqueeze(0), target_exp_concat[:1])
+    frame_bytes = max(torch.cuda.max_memory_allocated() - allocated, 1)
+
+    free_bytes, _ = torch.cuda.mem_get_info()
+    free_bytes += torch.cuda.memory_reserved() - torch.cuda.memory_allocated()
+    return int(max(1, min(max_split_size, 0.9 * free_bytes // frame_bytes)))
+
+
+def array_to_cuda(array, dtype):
+    """dtype tensor of array on the GPU, uploaded asynchronously.
+
+    The array is copied straight into a pinned host buffer of the target dtype, so a strided view
+    and a dtype change cost a single host copy.
+    """
+    tensor = torch.empty(array.shape, dtype=dtype, pin_memory=True)
+    np.copyto(tensor.numpy(), array)
+    return tensor.cuda(non_blocking=True)
 
-    target_exp_seq = np.load(exp_path)
 
+def load_src_img(src_img_path):
     frame = cv2.imread(src_img_path)
     frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
     src_img_raw = Image.fromarray(frame)
@@ -48,34 +133,191 @@ def render_video(
             transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5), inplace=True),
         ]
     )
-    src_img = image_transform(src_img_raw)
-
-    target_win_exps = []
-    for frame_idx in range(len(target_exp_seq)):
-        win_indices = obtain_seq_index(frame_idx, target_exp_seq.shape[0], semantic_radius)
-        win_exp = torch.tensor(target_exp_seq[win_indices]).permute(1, 0)
-        # (73, 27)
-        target_win_exps.append(win_exp)
-
-    target_exp_concat = torch.stack(target_win_exps, dim=0)
-    target_splited_exps = torch.split(target_exp_concat, split_size, dim=0)
-    output_imgs = []
-    for win_exp in target_splited_exps:
-        win_exp = win_exp.cuda()
-        cur_src_img = src_img.expand(win_exp.shape[0], -1, -1, -1).cuda()
-        output_dict = net_G(cur_src_img, win_exp)
-        output_imgs.append(output_dict["fake_image"].cpu().clamp_(-1, 1))
-
-    output_imgs = torch.cat(output_imgs, 0)
-    transformed_imgs = ((output_imgs + 1) / 2 * 255).to(torch.uint8).permute(0, 2, 3, 1)
+
+    return image_transform(src_img_raw).cuda()
+
+
+# (src_img, batch) of the most recent expand_src_img call, reused across files
+_src_img_batch = None
+
+
+def expand_src_img(src_img, split_size):
+    """Contiguous (split_size, C, H, W) batch of src_img, rebuilt only for a new image or a larger batch."""
+    global _src_img_batch
+    if _src_img_batch is None or _src_img_batch[0] is not src_img or len(_src_img_batch[1]) < split_size:
+        _src_img_batch = (src_img, src_img.unsqueeze(0).expand(split_size, -1, -1, -1).contiguous())
+
+    return _src_img_batch[1][:split_size]
+
+
+def to_uint8_frames(fake_image):
+    """(N, 3, H, W) images in [-1, 1] to (N, H, W, 3) uint8 frames, working in place on one fp32 copy."""
+    frames = fake_image.to(torch.float32, copy=True).add_(1).mul_(127.5).clamp_(0, 255)
+    return frames.to(torch.uint8).permute(0, 2, 3, 1)
+
+
+@torch.no_grad()
+def compile_for_inference(net_G, src_img, target_exp_concat, split_size):
+    """torch.compile'd net_G, warmed up once on the run's batch shape, or net_G itself if compiling fails.
+
+    to_uint8_frames is compiled alongside it and likewise stays eager on failure, e.g. where inductor
+    cannot build because Triton is missing. Returns the renderer and the batch size it was warmed up
+    with, halved from split_size while the CUDA graph's private memory pool does not fit.
+    """
+    global to_uint8_frames
+    if not hasattr(torch, "compile"):
+        return net_G, split_size
+    while True:
+        # fuses the pointwise ops and replays the batch shape as a CUDA graph
+        compiled_net_G = torch.compile(net_G, mode="reduce-overhead")
+        # one fused elementwise kernel instead of a pass per op
+        compiled_to_uint8_frames = torch.compile(to_uint8_frames, dynamic=True)
+        out_of_memory = False
+        try:
+            with autocast():
+                src_imgs = expand_src_img(src_img, split_size)
+                fake_image = compiled_net_G(src_imgs, target_exp_concat[:1].repeat(split_size, 1, 1))["fake_image"]
+            compiled_to_uint8_frames(fake_image)
+        except torch.cuda.OutOfMemoryError:
+            if split_size == 1:
+                raise
+            out_of_memory = True
+        except Exception as e:
+            print(f"Warning: torch.compile failed, rendering eagerly ({type(e).__name__}: {e})")
+            return net_G, split_size
+        if not out_of_memory:
+            break
+
+        # drop the graphs recorded for the failed shape before retrying with a smaller batch
+        del compiled_net_G, compiled_to_uint8_frames
+        torch._dynamo.reset()
+        torch.cuda.empty_cache()
+        split_size //= 2
+
+    to_uint8_frames = compiled_to_uint8_frames
+    return compiled_net_G, split_size
+
+
+def load_win_exps(exp_path, semantic_radius=13):
+    target_exp_seq = np.load(exp_path)
+
+    win_indices = obtain_seq_indices(target_exp_seq.shape[0], semantic_radius)
+    # (T, 73, 27)
+    return array_to_cuda(target_exp_seq[win_indices].transpose(0, 2, 1), torch.float32)
+
+
+@torch.no_grad()
+def render_video(
+    net_G,
+    src_img,
+    exp_path,
+    wav_path,
+    output_path,
+    silent=False,
+    semantic_radius=13,
+    fps=30,
+    split_size=None,
+    executor=None,
+):
+    """Renders exp_path to output_path.
+
+    Returns the renderer batch size that fitted, smaller than split_size after an OOM fallback, and the
+    mux future when executor is given (else None).
+    """
+    target_exp_concat = load_win_exps(exp_path, semantic_radius)
+    num_frames = len(target_exp_concat)
+    if split_size is None:
+        split_size = get_split_size(net_G, src_img, target_exp_concat)
+
+    cur_src_img = expand_src_img(src_img, split_size)
+    transformed_imgs = torch.empty((num_frames, *src_img.shape[1:], 3), dtype=torch.uint8, device="cuda")
+    # finished chunks are copied back on a side stream while the next chunk renders
+    copy_stream = torch.cuda.Stream()
+    host_imgs = torch.empty(transformed_imgs.shape, dtype=torch.uint8, pin_memory=True)
+    start = 0
+    while start < num_frames:
+        win_exp = target_exp_concat[start : start + split_size]
+        n = win_exp.shape[0]
+        if n < split_size:
+            # pad short clips and the tail chunk so every call replays the same captured graph
+            win_exp = torch.cat([win_exp, win_exp[-1:].expand(split_size - n, -1, -1)])
+        out_of_memory = False
+        try:
+            with autocast():
+                fake_image = net_G(cur_src_img, win_exp)["fake_image"][:n]
+        except torch.cuda.OutOfMemoryError:
+            if split_size == 1:
+                raise
+            out_of_memory = True
+        if out_of_memory:
+            # fall back to a smaller batch instead of aborting the whole file; retried outside the
+            # except block, once the traceback no longer holds the failed forward's tensors
+            torch.cuda.empty_cache()
+            split_size //= 2
+            cur_src_img = cur_src_img[:split_size]
+            continue
+        transformed_imgs[start : start + n] = to_uint8_frames(fake_image)
+        copy_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(copy_stream):
+            host_imgs[start : start + n].copy_(transformed_imgs[start : start + n], non_blocking=True)
+        start += n
+
+    copy_stream.synchronize()
+    transformed_imgs = host_imgs
 
     if silent:
-        torchvision.io.write_video(output_path, transformed_imgs.cpu(), fps)
+        torchvision.io.write_video(output_path, transformed_imgs, fps)
+    elif executor is None:
+        mux_video(transformed_imgs, wav_path, output_path, fps)
     else:
-        silent_video_path = "silent.mp4"
-        torchvision.io.write_video(silent_video_path, transformed_imgs.cpu(), fps)
-        os.system(f"ffmpeg -loglevel quiet -y -i {silent_video_path} -i {wav_path} -shortest {output_path}")
-        os.remove(silent_video_path)
+        # the caller can start on the next file while ffmpeg encodes this one
+        return split_size, executor.submit(mux_video, transformed_imgs, wav_path, output_path, fps)
+
+    return split_size, None
+
+    return None
+
+
+def mux_video(frames, wav_path, output_path, fps):
+    """Encodes (T, H, W, 3) uint8 frames and muxes them with wav_path in a single ffmpeg pass."""
+    height, width = frames.shape[1:3]
+    # fmt: off
+    ffmpeg_cmd = [
+        "ffmpeg", "-loglevel", "quiet", "-y",
+        "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{width}x{height}", "-r", str(fps), "-i", "pipe:0",
+        "-i", wav_path,
+        *get_video_encoder_args(), "-pix_fmt", "yuv420p", "-shortest", output_path,
+    ]
+    # fmt: on
+    ffmpeg = subprocess.Popen(ffmpeg_cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, bufsize=1 << 20)
+    ffmpeg.communicate(frames.numpy().data)
+    if ffmpeg.returncode != 0:
+        raise subprocess.CalledProcessError(ffmpeg.returncode, ffmpeg.args)
+
+
+def wait_for_mux(base_name, muxing):
+    """Waits for one video's ffmpeg pass, reporting a failure instead of aborting the remaining files."""
+    try:
+        muxing.result()
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f"Error: could not write {base_name}.mp4: {e}")
+
+
+@functools.lru_cache(maxsize=None)
+def get_video_encoder_args():
+    """h264_nvenc when this ffmpeg build and GPU can encode a probe frame with it, libx264 otherwise."""
+    nvenc_args = ["-c:v", "h264_nvenc", "-preset", "p1", "-tune", "ull"]
+    # fmt: off
+    probe_cmd = [
+        "ffmpeg", "-loglevel", "quiet",
+        "-f", "lavfi", "-i", "nullsrc=s=256x256", "-frames:v", "1", *nvenc_args, "-f", "null", "-",
+    ]
+    # fmt: on
+    probe = subprocess.run(probe_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if probe.returncode == 0:
+        return nvenc_args
+
+    return ["-c:v", "libx264", "-preset", "veryfast"]
 
 
 @torch.no_grad()
@@ -88,48 +330,55 @@ def get_netG(checkpoint_path):
 
     renderer = FaceGenerator(**renderer_config).to(torch.cuda.current_device())
 
-    checkpoint = torch.load(checkpoint_path, map_location=lambda storage, loc: storage)
+    # kept on the CPU: load_state_dict copies only net_G_ema to the GPU, not the rest of the training state
+    checkpoint = load_checkpoint(checkpoint_path, "cpu")
     renderer.load_state_dict(checkpoint["net_G_ema"], strict=False)
 
     renderer.eval()
-
     return renderer
 
 
 @torch.no_grad()
-def generate_expression_params(
-    cfg, audio_path, style_clip_path, pose_path, output_path, content_encoder, style_encoder, decoder
-):
+def get_style_code(style_clip_path, style_encoder):
+    style_clip, pad_mask = get_video_style_clip(style_clip_path, style_max_len=256, start_idx=0)
+    with autocast():
+        style_code = style_encoder(
+            style_clip.unsqueeze(0).cuda(), pad_mask.unsqueeze(0).cuda() if pad_mask is not None else None
+        )
+
+    return style_code
+
+
+def load_inputs(cfg, audio_path, pose_path):
+    """CPU-side inputs of one file: phoneme windows and pose parameters."""
     with open(audio_path, "r") as f:
         audio = json.load(f)
 
     audio_win = get_audio_window(audio, cfg.WIN_SIZE)
-    audio_win = torch.tensor(audio_win).cuda()
-    content = content_encoder(audio_win.unsqueeze(0))
+    pose = load_pose_params(pose_path)
+    # (L, 9)
 
-    style_clip, pad_mask = get_video_style_clip(style_clip_path, style_max_len=256, start_idx=0)
-    style_code = style_encoder(
-        style_clip.unsqueeze(0).cuda(), pad_mask.unsqueeze(0).cuda() if pad_mask is not None else None
-    )
+    return audio_win, pose
 
-    gen_exp_stack = decoder(content, style_code)
-    gen_exp = gen_exp_stack[0].cpu().numpy()
 
-    pose_ext = pose_path[-3:]
-    pose = None
-    if pose_ext == "npy":
-        pose = np.load(pose_path)
-    elif pose_ext == "mat":
-        pose = get_pose_params(pose_path)
-    # (L, 9)
+@torch.no_grad()
+def generate_expression_params(audio_win, style_code, pose, output_path, content_encoder, decoder):
+    audio_win = array_to_cuda(audio_win, torch.long)
 
-    if len(pose) >= len(gen_exp):
-        selected_pose = pose[: len(gen_exp)]
-    else:
-        # РЎРѕР·РґР°РµРј РјР°СЃСЃРёРІ СЃ РїРѕРІС‚РѕСЂРµРЅРёРµРј РїРѕСЃР»РµРґРЅРµРіРѕ РєР°РґСЂР° РїРѕР·С‹, С‡С‚РѕР±С‹ РґР»РёРЅР° СЃРѕРІРїР°РґР°Р»Р°
-        selected_pose = np.vstack([pose, np.tile(pose[-1], (len(gen_exp) - len(pose), 1))])
+    with autocast():
+        content = content_encoder(audio_win.unsqueeze(0))
+        gen_exp_stack = decoder(content, style_code)
+
+    gen_exp = gen_exp_stack[0].float().cpu().numpy()
+
+    num_frames, exp_dim = gen_exp.shape
+    num_pose_frames = min(len(pose), num_frames)
+    gen_exp_pose = np.empty((num_frames, exp_dim + pose.shape[1]), dtype=np.result_type(gen_exp, pose))
+    gen_exp_pose[:, :exp_dim] = gen_exp
+    gen_exp_pose[:num_pose_frames, exp_dim:] = pose[:num_pose_frames]
+    # РЎРѕР·РґР°РµРј РјР°СЃСЃРёРІ СЃ РїРѕРІС‚РѕСЂРµРЅРёРµРј РїРѕСЃР»РµРґРЅРµРіРѕ РєР°РґСЂР° РїРѕР·С‹, С‡С‚РѕР±С‹ РґР»РёРЅР° СЃРѕРІРїР°РґР°Р»Р°
+    gen_exp_pose[num_pose_frames:, exp_dim:] = pose[-1]
 
-    gen_exp_pose = np.concatenate((gen_exp, selected_pose), axis=1)
     np.save(output_path, gen_exp_pose)
 
 
@@ -152,34 +401,76 @@ if __name__ == "__main__":
     with torch.no_grad():
         content_encoder, style_encoder, decoder = get_eval_model(cfg)
         image_renderer = get_netG("checkpoints/renderer_checkpoint.pt")
-        
+        # the style clip and source image are the same for every file, so they are prepared once
+        style_code = get_style_code(style_clip_path, style_encoder)
+        src_img = load_src_img(src_img_path)
+        split_size = None
+        reserved_bytes = None
+
+        inputs = []
         for filename in os.listdir(phoneme_dir):
-            print(f"Обрабатываю {filename}")
             if filename.endswith(".json"):
                 base_name = os.path.splitext(filename)[0]
                 phoneme_path = os.path.join(phoneme_dir, filename)
                 pose_path = os.path.join(pose_dir, f"{base_name}.mat")
+                inputs.append((base_name, phoneme_path, pose_path))
+
+        # one worker prefetches the next file's json/mat while the GPU works on the current one, two
+        # more run ffmpeg; all GPU work stays on this thread so results do not depend on scheduling
+        with ThreadPoolExecutor(max_workers=1) as io_pool, ThreadPoolExecutor(max_workers=2) as mux_pool:
+            # (base_name, future) of videos still being muxed; each holds its frames in host memory
+            pending = collections.deque()
+            next_inputs = io_pool.submit(load_inputs, cfg, *inputs[0][1:]) if inputs else None
+            for i, (base_name, phoneme_path, pose_path) in enumerate(inputs):
+                print(f"Обрабатываю {base_name}.json")
+                audio_win, pose = next_inputs.result()
+                if i + 1 < len(inputs):
+                    next_inputs = io_pool.submit(load_inputs, cfg, *inputs[i + 1][1:])
+
                 wav_path = os.path.join(wav_dir, f"{base_name}.wav")
                 output_path = os.path.join(output_dir, f"{base_name}.mp4")
-                
                 exp_param_path = f"{output_path[:-4]}.npy"
-		#print(f"{phoneme_path} {style_clip_path} {pose_path} {exp_param_path} {content_encoder} {style_encoder} {decoder}")
+
                 generate_expression_params(
-                    cfg,
-                    phoneme_path,
-                    style_clip_path,
-                    pose_path,
+                    audio_win,
+                    style_code,
+                    pose,
                     exp_param_path,
                     content_encoder,
-                    style_encoder,
                     decoder,
                 )
-                
-                render_video(
+
+                if split_size is None:
+                    # probed and compiled on the first file only: one renderer batch shape for the whole run
+                    target_exp_concat = load_win_exps(exp_param_path)
+                    split_size = get_split_size(image_renderer, src_img, target_exp_concat)
+                    psnr = autocast_psnr(image_renderer, src_img, target_exp_concat)
+                    print(f"Autocast vs fp32 renderer PSNR on the first frame: {psnr:.2f} dB")
+                    image_renderer, split_size = compile_for_inference(
+                        image_renderer, src_img, target_exp_concat, split_size
+                    )
+                    del target_exp_concat
+
+                # later files start from the batch that fitted, not the probed one
+                split_size, muxing = render_video(
                     image_renderer,
-                    src_img_path,
+                    src_img,
                     exp_param_path,
                     wav_path,
                     output_path,
-                    split_size=4,
+                    split_size=split_size,
+                    executor=mux_pool,
                 )
+                if muxing is not None:
+                    pending.append((base_name, muxing))
+                if len(pending) > 2:
+                    wait_for_mux(*pending.popleft())
+
+                # keep the pool warm for the next file unless it grows past its high-water mark
+                reserved = torch.cuda.memory_reserved()
+                if reserved_bytes is not None and reserved > reserved_bytes:
+                    torch.cuda.empty_cache()
+                reserved_bytes = max(reserved_bytes or 0, reserved)
+
+            while pending:
+                wait_for_mux(*pending.popleft())